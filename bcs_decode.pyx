@@ -0,0 +1,93 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# distutils: extra_compile_args = -O3 -march=native
+'''
+Compiled decoding of the parts of a BCS frame.
+
+Build in place with:
+    cythonize -i bcs_decode.pyx
+pva_broadcast falls back to its pure Python parsing if this is not built.
+'''
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from libc.stdint cimport uint32_t
+import numpy as np
+
+cdef unsigned char CR = 13
+cdef unsigned char LF = 10
+cdef unsigned char SPACE = 32
+cdef unsigned char MINUS = 45
+cdef unsigned char PLUS = 43
+cdef unsigned char ZERO = 48
+cdef unsigned char NINE = 57
+
+cdef object parse_int(const unsigned char[::1] buf, Py_ssize_t start, Py_ssize_t end):
+    '''Parse a decimal integer from buf[start:end].
+    Plain signed digits that fit in a long long are converted here.  Anything else
+    (whitespace, underscores, very long numbers, bad values) goes to int(), so
+    the result and any ValueError match the pure Python parsing.
+    '''
+    cdef Py_ssize_t i = start
+    cdef long long sign = 1
+    cdef long long value = 0
+    if i < end and (buf[i] == MINUS or buf[i] == PLUS):
+        if buf[i] == MINUS:
+            sign = -1
+        i += 1
+    #18 digits always fit in a 64 bit long long
+    if i == end or end - i > 18:
+        return int(PyBytes_FromStringAndSize(<const char*>&buf[start], end - start))
+    while i < end:
+        if buf[i] < ZERO or buf[i] > NINE:
+            return int(PyBytes_FromStringAndSize(<const char*>&buf[start], end - start))
+        value = value * 10 + (buf[i] - ZERO)
+        i += 1
+    return sign * value
+
+
+cpdef dict parse_params(const unsigned char[::1] buf, dict param_fields):
+    '''Parse the params part of a frame.
+    param_fields maps keys in the params to (FrameParams field name, converter),
+    as pva_broadcast.PARAM_FIELDS does.  Values for int fields are converted here.
+    Returns a dict of FrameParams field names to converted values,
+    for the fields present in the params.
+    '''
+    cdef dict fields = {}
+    cdef Py_ssize_t n = buf.shape[0]
+    cdef Py_ssize_t start = 0
+    cdef Py_ssize_t end, space, value_start
+    cdef bytes key
+    cdef object field, name, convert
+    while start < n:
+        end = start
+        while end < n and buf[end] != CR and buf[end] != LF:
+            end += 1
+        space = start
+        while space < end and buf[space] != SPACE:
+            space += 1
+        value_start = space + 1 if space < end else end
+        if space > start:
+            key = PyBytes_FromStringAndSize(<const char*>&buf[start], space - start)
+            field = param_fields.get(key)
+            if field is not None:
+                name, convert = field
+                if convert is int:
+                    fields[name] = parse_int(buf, value_start, end)
+                else:
+                    fields[name] = convert(PyBytes_FromStringAndSize(<const char*>&buf[value_start], end - value_start))
+        start = end + 1
+    return fields
+
+
+cpdef object decode_info(const unsigned char[::1] buf):
+    '''Decode the big-endian uint32 words of the info part, after its 4 byte prefix,
+    into a native uint32 array.
+    The image is info[1] rows by info[0] columns and info[4] is the frame number.
+    '''
+    cdef Py_ssize_t count = max(0, (buf.shape[0] - 4) // 4)
+    cdef Py_ssize_t i, offset
+    info = np.empty(count, dtype=np.uint32)
+    cdef uint32_t[::1] words = info
+    for i in range(count):
+        offset = 4 + 4 * i
+        words[i] = ((<uint32_t>buf[offset] << 24) | (<uint32_t>buf[offset + 1] << 16)
+                    | (<uint32_t>buf[offset + 2] << 8) | <uint32_t>buf[offset + 3])
+    return info
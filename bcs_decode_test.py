@@ -0,0 +1,57 @@
+import sys
+
+import numpy as np
+import pytest
+
+bcs_decode = pytest.importorskip("bcs_decode")
+pva_broadcast = pytest.importorskip("pva_broadcast")
+
+
+PARAMS = [b"-nrays 2560\r\n-nslices 2160\r\n-nangles 1313\r\n-arange 180\r\n-image_key 0\r\n-dtype \r\n",
+          b"+nrays 640\n+nslices 480\n-image_key 2",
+          b"-nrays 2560 \r\n",
+          b"-nrays  2560\r\n",
+          b"-nrays 1_000\r\n",
+          b"-nangles 99999999999999999999\r\n",
+          b"-nangles 999999999999999999\r\n",
+          b"-nangles 9999999999999999999\r\n",
+          b"-nangles -5\r\n-image_key +1\r\n",
+          b"-nangles -0\r\n",
+          b"-nangles\r\n",
+          b"-nangles \r\n",
+          b"-nangles -\r\n",
+          b"-nangles 12x\r\n",
+          b"-arange  180.5 \r\n",
+          b"-dtype uint16\r\n",
+          b"\r\n\r\n-image_key 1\r\n\r\n",
+          b"-writedone",
+          b"",
+          ]
+
+
+@pytest.mark.parametrize("params", PARAMS)
+def test_parse_params_matches_python(params):
+    '''The compiled parser gives the same FrameParams, or the same error, as the pure Python one.
+    '''
+    reader = pva_broadcast.ReadBCSTomoData()
+    try:
+        expected = reader.parse_params_python(params)
+    except ValueError:
+        with pytest.raises(ValueError):
+            bcs_decode.parse_params(params, pva_broadcast.PARAM_FIELDS)
+        return
+    assert pva_broadcast.FrameParams(**bcs_decode.parse_params(params, pva_broadcast.PARAM_FIELDS)) == expected
+
+
+def test_decode_info_matches_numpy():
+    '''The compiled info decoding gives the same uint32 array as the numpy one.
+    '''
+    words = np.array([4, 2560, 2160, 0, 123456, 2**32 - 1], dtype='>u4')
+    buf = words.tobytes()
+    expected = np.frombuffer(buf, dtype='>u4', offset=4)
+    if sys.byteorder == 'little':
+        expected = expected.byteswap().view(np.uint32)
+    info = bcs_decode.decode_info(buf)
+    assert isinstance(info, np.ndarray)
+    assert info.dtype == expected.dtype
+    np.testing.assert_array_equal(info, expected)
@@ -1,9 +1,24 @@
-import time
+import sys
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
 import numpy as np
 import epics
 import zmq
+import zmq.asyncio
 import pva_instance as pvai
+try:
+    import uvloop
+except ImportError:
+    #Fall back to the default asyncio event loop.
+    uvloop = None
+try:
+    import bcs_decode
+except ImportError:
+    #The compiled decoder has not been built.  Use the pure Python parsing.
+    bcs_decode = None
 
 
 logger = logging.getLogger("beamline")
@@ -28,6 +43,57 @@ beamline = "bl832"
 tomostream_prefix = 'ALS832:TomoStream:'
 
 
+@dataclass(slots=True)
+class FrameParams:
+    '''Typed values parsed from the params part of a BCS frame.
+    image_key is None if the params did not describe an image frame.
+    nangles and arange are None if the params did not give the scan geometry.
+    '''
+    nrays: int = 0
+    nslices: int = 0
+    nangles: Optional[int] = None
+    arange: Optional[float] = None
+    image_key: Optional[int] = None
+    #Right now, this just gives uint16.
+    #This should be changed to read what the camera is really doing.
+    dtype: str = 'uint16'
+
+
+#Keys in the BCS params, kept as bytes so the params never need decoding
+KEY_NRAYS = b'-nrays'
+KEY_NRAYS_ALT = b'+nrays'
+KEY_NSLICES = b'-nslices'
+KEY_NSLICES_ALT = b'+nslices'
+KEY_NANGLES = b'-nangles'
+KEY_ARANGE = b'-arange'
+KEY_IMAGE = b'-image_key'
+KEY_DTYPE = b'-dtype'
+
+#Maps keys in the BCS params to the FrameParams field and its conversion.
+#int() and float() accept bytes directly, so only dtype needs decoding.
+#bcs_decode.parse_params is given this same table, so both parsers read the same keys.
+PARAM_FIELDS = {KEY_NRAYS: ('nrays', int),
+                KEY_NRAYS_ALT: ('nrays', int),
+                KEY_NSLICES: ('nslices', int),
+                KEY_NSLICES_ALT: ('nslices', int),
+                KEY_NANGLES: ('nangles', int),
+                KEY_ARANGE: ('arange', float),
+                KEY_IMAGE: ('image_key', int),
+                KEY_DTYPE: ('dtype', lambda value: value.decode() or 'uint16'),
+                }
+
+
+#Tags at the start of the params that mark messages which are not image frames
+PARAM_TAGS = {b'-writedone': 'final',
+              b'-delete': 'delete',
+              b'meta data': 'garbage',
+              }
+#The tags differ within their first PARAM_TAG_LENGTH bytes, so one dict lookup
+#on that many bytes of the params finds the only tag that can match.
+PARAM_TAG_LENGTH = min(len(tag) for tag in PARAM_TAGS)
+PARAM_TAG_HEADS = {tag[:PARAM_TAG_LENGTH]: (tag, name) for tag, name in PARAM_TAGS.items()}
+
+
 class Args:
     '''Dummy class to hold channel name for instantiating PVABroadcast objects.
     '''
@@ -35,6 +101,8 @@ class Args:
 
 
 class TomoStreamPVASet:
+    ANCILLARY_PVS = ('NumAngles', 'RotationStep', 'FrameType')
+
     def __init__(self, 
                 data_channel_name = "tomostreamdata:proj:image",
                 white_channel_name = "tomostreamdata:white:image",
@@ -51,6 +119,18 @@ class TomoStreamPVASet:
                             self.dark_broadcast, 
                             self.white_broadcast, 
                             self.theta_broadcast]
+        #Maps image_key to the broadcaster for that frame type
+        #and whether it is a projection, which also needs theta
+        self.router = {0: (self.data_broadcast, True),
+                       1: (self.white_broadcast, False),
+                       2: (self.dark_broadcast, False),
+                       }
+        #epics.PV objects for the TomoStream PVs, keyed by PV name
+        self.pvs = {}
+        #Last values successfully put to the ANCILLARY_PVS
+        self.last_ancillary = (None, None, None)
+        #float32 theta arrays, keyed by (num_angles, angle_range)
+        self.theta_cache = {}
        
     def set_up_pva_streams(self,
                         data_channel_name = "tomostreamdata:proj:image",
@@ -76,133 +156,174 @@ class TomoStreamPVASet:
         for i in self.broadcasters:
             i.stop()
 
-    def broadcast_image(self, frame_data, param_dict, frameID):
+    def broadcast_image(self, frame_data, params, frameID):
         '''Broadcast the frame to the right PVA stream.
         '''
-        if '-image_key' not in param_dict.keys():
+        broadcaster, is_projection = self.router.get(params.image_key, (None, False))
+        if broadcaster is None:
             print('Not a valid image frame.  Skipping.')
-            for i in param_dict.keys():
-                print(i, param_dict[i])
+            print(params)
             return
-        #Parse out the data we need
-        columns, rows, dtype = self.parse_image_params(param_dict)
 
-        #Projection frame
-        if int(param_dict['-image_key']) == 0:
-            self.data_broadcast.frameProducer(frameID, frame_data, columns, rows, dtype, None, t=0)
+        broadcaster.frameProducer(frameID, frame_data, params.nrays, params.nslices, params.dtype, None, t=0)
+        if is_projection:
             #Broadcast the theta values
-            self.broadcast_theta(param_dict)
-        elif int(param_dict['-image_key']) == 1:
-            self.white_broadcast.frameProducer(frameID, frame_data, columns, rows, dtype, None, t=0)
-        elif int(param_dict['-image_key']) == 2:
-            self.dark_broadcast.frameProducer(frameID, frame_data, columns, rows, dtype, None, t=0)
+            self.broadcast_theta(params)
 
         #Change the ancillary PVs in TomoStream
-        self.update_ancillary_pvs(tomostream_prefix, param_dict)
-
+        self.update_ancillary_pvs(tomostream_prefix, params)
 
-    def parse_image_params(self, param_dict):
-        '''Parse the rows, columns, and dtype from params dictionary.
-        '''
-        param_keys = param_dict.keys()
-        if '-nrays' in param_keys:
-            columns = param_dict['-nrays']
-        elif '+nrays' in param_keys:
-            columns = param_dict['+nrays']
-        else:
-            print("Can't find the number of columns in the image param dictionary")
-            return 0, 0, 'uint16'
-        if '-nslices' in param_keys:
-            rows = param_dict['-nslices']
-        elif '+nslices' in param_keys:
-            rows = param_dict['+nslices']
-        else:
-            print("Can't find the number of columns in the image param dictionary")
-            return 0, 0, 'uint16'
-        #Find dtype.  Right now, this just gives uint16.
-        #This should be changed to read what the camera is really doing.
-        if '-dtype' in param_keys:
-            if param_dict['-dtype'] == "":
-                dtype = 'uint16'
-        return columns, rows, dtype
 
-
-    def update_ancillary_pvs(self, ts_prefix, param_dict):
+    def update_ancillary_pvs(self, ts_prefix, params):
         '''Updates the FrameType, NumAngles, RotationStep PVs in TomoStream.
         '''
-        num_angles = int(param_dict['-nangles'])
-        epics.caput(ts_prefix + 'NumAngles', num_angles)
-        rotation_step = float(param_dict['-arange']) / (num_angles - 1)
-        epics.caput(ts_prefix + 'RotationStep', rotation_step)
-        epics.caput(ts_prefix + 'FrameType', param_dict['-image_key'])
+        if params.nangles is None or params.arange is None:
+            logger.debug('No scan geometry in the frame params.  Not updating TomoStream PVs.')
+            return
+        rotation_step = params.arange / (params.nangles - 1)
+        values = (params.nangles, rotation_step, params.image_key)
+        #These rarely change within a scan, so only put the ones that did.
+        if values == self.last_ancillary:
+            return
+        #Don't wait for the puts to complete, so they don't hold up the next frame.
+        #Skip PVs that are not connected yet rather than blocking in put until
+        #they time out.  Their old value is kept, so the next frame tries again.
+        sent = list(self.last_ancillary)
+        for i, (pv_suffix, value) in enumerate(zip(self.ANCILLARY_PVS, values)):
+            if value != sent[i]:
+                pv = self.get_pv(ts_prefix + pv_suffix)
+                if pv.connected and pv.put(value, wait=False) is not None:
+                    sent[i] = value
+        self.last_ancillary = tuple(sent)
+
+    def get_pv(self, pv_name):
+        '''Returns a cached epics.PV, so each PV is only connected once.
+        '''
+        pv = self.pvs.get(pv_name)
+        if pv is None:
+            pv = epics.PV(pv_name)
+            self.pvs[pv_name] = pv
+        return pv
 
     
-    def broadcast_theta(self, param_dict):
+    def broadcast_theta(self, params):
         '''Computes the angle range from the meta data for a projection image.
         '''
-        num_angles = int(param_dict['-nangles'])
-        angle_range = float(param_dict['-arange'])
-        angles = np.linspace(0, angle_range, num_angles)
+        if params.nangles is None or params.arange is None:
+            logger.debug('No scan geometry in the frame params.  Not computing theta.')
+            return
+        num_angles = params.nangles
+        angle_range = params.arange
+        #The scan geometry is fixed, so only compute the angles once per scan
+        key = (num_angles, angle_range)
+        angles = self.theta_cache.get(key)
+        if angles is None:
+            angles = np.linspace(0, angle_range, num_angles, dtype=np.float32)
+            self.theta_cache[key] = angles
         logger.info('Theta computed, but broadcast not implemented.')
 
 
 class ReadBCSTomoData(object):
-    def read(self, socket):
-        START_TAG = b"[start]"  
-        END_TAG = b"[end]"
+    START_TAG = b"[start]"
+    END_TAG = b"[end]"
+    NUM_PARTS = 7
+
+    async def read(self, socket):
+        parts = await self.recv_parts(socket)
+        if parts is None:
+            logger.debug('Invalid frame: ignore')
+            return None
 
+        #Small parts are copied to bytes.  The image and info arrays are read
+        #straight from the zmq.Frame buffers, which the arrays keep alive if needed.
         data_obj = {}
-        data_obj["start"] = self.sock_recv(socket)
-        data_obj["image"] = self.sock_recv(socket)
-        data_obj["info"] = self.sock_recv(socket)
-        data_obj["h5_file"] = self.sock_recv(socket)
-        data_obj["tif_file"] = self.sock_recv(socket)
-        data_obj["params"] = self.sock_recv(socket)
-        data_obj["end"] = self.sock_recv(socket)
+        data_obj["start"] = parts[0].bytes
+        data_obj["h5_file"] = parts[3].bytes
+        data_obj["tif_file"] = parts[4].bytes
+        data_obj["params"] = parts[5].bytes
+        data_obj["end"] = parts[6].bytes
         
-        info = np.frombuffer(data_obj["info"][4:], dtype=">u4")
+        #BCS sends big-endian data.  On little-endian hosts the byteswap makes the
+        #one native-order copy of the image, so nothing downstream converts it again.
+        if bcs_decode is not None:
+            info = bcs_decode.decode_info(parts[2].buffer)
+        else:
+            info = np.frombuffer(parts[2].buffer, dtype=">u4", offset=4)
+            if sys.byteorder == 'little':
+                info = info.byteswap().view(np.uint32)
+        image = np.frombuffer(parts[1].buffer, dtype=">u2", offset=4)
+        if sys.byteorder == 'little':
+            image = image.byteswap().view(np.uint16)
         data_obj["info"] = info
         print(data_obj["info"])
 
-        image = np.frombuffer(data_obj["image"][4:], dtype=">u2")
-        image = image.reshape((1, info[1], info[0]))
+        image = image.reshape((info[1], info[0]))
         data_obj["image"] = image
+        return data_obj
 
-        if data_obj["start"].startswith(START_TAG) and data_obj["end"].startswith(END_TAG):
-            return data_obj
-        else:
-            logger.debug('Invalid frame: ignore')
-            return None, None
+    async def recv_parts(self, socket):
+        '''Receive the parts of one frame, from [start] to [end].
+        A multipart message arrives in a single call.  If the parts were sent
+        as separate messages, keep receiving until the [end] part shows up.
+        Returns None if the parts do not form a valid frame.
+        '''
+        parts = await socket.recv_multipart(copy=False)
+        if not self.has_tag(parts[0], self.START_TAG):
+            return None
+        while not self.has_tag(parts[-1], self.END_TAG):
+            if len(parts) >= self.NUM_PARTS:
+                return None
+            parts.extend(await socket.recv_multipart(copy=False))
+        if len(parts) != self.NUM_PARTS:
+            return None
+        return parts
+
+    def has_tag(self, part, tag):
+        '''Checks whether a zmq.Frame starts with tag, without copying the whole frame.
+        '''
+        return part.buffer[:len(tag)] == tag
 
 
+    def param_tag(self, data_obj):
+        '''Returns the name from PARAM_TAGS of the tag the params start with, or None.
+        '''
+        params = data_obj["params"]
+        head = PARAM_TAG_HEADS.get(params[:PARAM_TAG_LENGTH])
+        if head is not None and params.startswith(head[0]):
+            return head[1]
+        return None
+
     def is_final(self, data_obj):
-        FINAL_TAG = b"-writedone"
-        return data_obj["params"].startswith(FINAL_TAG)
+        return self.param_tag(data_obj) == 'final'
 
     def is_delete(self, data_obj):
-        FINAL_TAG = b"-delete"
-        return data_obj["params"].startswith(FINAL_TAG)
+        return self.param_tag(data_obj) == 'delete'
 
     def is_garbage(self, data_obj):
-        return data_obj["params"].startswith(b"meta data")
+        return self.param_tag(data_obj) == 'garbage'
 
     def is_null_frame(self, data_obj):
-        return (data_obj['image'].shape[1] + data_obj['image'].shape[2]) <= 3
+        return (data_obj['image'].shape[0] + data_obj['image'].shape[1]) <= 3
 
-    def sock_recv(self, socket):
-        msg = socket.recv()
-        return msg
-    
-    def params_to_dict(self, params):
-        kv_pair_list = params.decode().split('\r\n')
-        output_dict = {}
-        for i in kv_pair_list:
-            kv_split = i.split(' ')
-            if len(kv_split) > 1:
-                output_dict[kv_split[0]] = kv_split[1]
-            else:
-                output_dict[kv_split[0]] = ""
-        return output_dict
+    def parse_params(self, params):
+        '''Parse the params part of a frame into a FrameParams in a single pass.
+        Works on the raw bytes, so only the values we use are ever converted.
+        '''
+        if bcs_decode is not None:
+            return FrameParams(**bcs_decode.parse_params(params, PARAM_FIELDS))
+        return self.parse_params_python(params)
+
+    def parse_params_python(self, params):
+        '''Pure Python version of parse_params, used when bcs_decode is not built.
+        '''
+        frame_params = FrameParams()
+        for line in params.splitlines():
+            key, _, value = line.partition(b' ')
+            field = PARAM_FIELDS.get(key)
+            if field is not None:
+                name, convert = field
+                setattr(frame_params, name, convert(value))
+        return frame_params
     
 
 ### main from ZMQ ALS code
@@ -212,63 +333,147 @@ class ZMQ_Stream:
                 zmq_pub_port,
                 beamline,
                 pva_set,
+                queue_size = 4,
+                io_threads = 2,
+                rcvhwm = 32,
+                rcvbuf = 4 * 1024 * 1024,
+                linger = 0,
+                batch_size = 16,
                 ):
         logger.info(f"zmq_pub_address: {zmq_pub_address}")
         logger.info(f"zmq_pub_port: {zmq_pub_port}")
         
         # set connection
-        ctx = zmq.Context()
+        ctx = zmq.asyncio.Context(io_threads=io_threads)
         self.socket = ctx.socket(zmq.SUB)
+        #Buffer sizes must be set before connecting to take effect
+        self.socket.setsockopt(zmq.RCVHWM, rcvhwm)
+        self.socket.setsockopt(zmq.RCVBUF, rcvbuf)
+        self.socket.setsockopt(zmq.LINGER, linger)
         logger.info(f"binding to: {zmq_pub_address}:{zmq_pub_port}")
         self.socket.connect(f"{zmq_pub_address}:{zmq_pub_port}")
         self.socket.setsockopt(zmq.SUBSCRIBE, b"")
         
         self.reader = ReadBCSTomoData()
         self.pva_set = pva_set
+
+        #Pipeline stages: recv -> decode -> publish, run as asyncio tasks.
+        #The queues are bounded, so a slow stage backs up the ones before it
+        #rather than using up RAM.  frame_queue holds batches of up to batch_size
+        #frames, so it is sized in batches: it holds at most
+        #max(1, queue_size // batch_size) * batch_size frames.
+        #publish_queue holds single frames, at most queue_size of them.
+        self.batch_size = batch_size
+        self.frame_queue = asyncio.Queue(maxsize=max(1, queue_size // batch_size))
+        self.publish_queue = asyncio.Queue(maxsize=queue_size)
+        #PVA updates and EPICS puts are blocking calls, so they run in this executor.
+        #A single worker keeps frames in order and uses one CA context.
+        self.executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix="publish",
+                                           initializer=epics.ca.use_initial_context)
     
-    def zmq_monitor_loop(self, sleep_time = 0.01):
+    async def zmq_monitor_loop(self):
         '''Endless loop to monitor ZeroMQ stream.
+        Runs the recv, decode, and publish stages as asyncio tasks,
+        so receiving the next frames overlaps with broadcasting the last one.
+        '''
+        tasks = [asyncio.create_task(self.recv_loop()),
+                 asyncio.create_task(self.decode_loop()),
+                 asyncio.create_task(self.publish_loop()),
+                 ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for t in tasks:
+                t.cancel()
+            self.executor.shutdown(wait=True)
+
+    async def recv_loop(self):
+        '''Receive frames from the ZeroMQ socket.
+        After waiting for one frame, up to batch_size frames already queued on
+        the socket are read too, and handed on to the decode stage as one batch.
         '''
-        data_obj = None
         while True:
-            time.sleep(sleep_time)
+            batch = []
             try:
-                data_obj = self.reader.read(self.socket)
-                print("Got a data object")
-                if self.reader.is_final(data_obj):
-                    logger.info("Received -writedone from LabView")
-                    continue
-                elif self.reader.is_garbage(data_obj):
-                    logger.info("!!! Ignoring message with garbage metadata tag from BCS. Probably after a restart.")
-                    continue
-                elif self.reader.is_null_frame(data_obj):
-                    logger.info('Found null frame.  Probably the beginning or end of a scan.')
-                    continue
-                #We must have a valid frame.  Let's broadcast it.
-                #Send the frame data, the parameters, and the frame number
-                param_dict = self.reader.params_to_dict(data_obj['params'])
-                self.pva_set.broadcast_image(data_obj['image'][0,...],
-                                            param_dict,
-                                            data_obj['info'][4])
-                    
-            except KeyboardInterrupt as e:
-                logger.error("Ctrl-C Interruption detected, Quitting...")
-                break
+                data_obj = await self.reader.read(self.socket)
+                if data_obj is not None:
+                    batch.append(data_obj)
+                while len(batch) < self.batch_size and self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                    data_obj = await self.reader.read(self.socket)
+                    if data_obj is not None:
+                        batch.append(data_obj)
             except Exception as e:
                 logger.exception("Frame object failed to parse:")
+            if batch:
+                await self.frame_queue.put(batch)
+
+    async def decode_loop(self):
+        '''Take batches of frames from the recv stage and decode them.
+        '''
+        while True:
+            batch = await self.frame_queue.get()
+            for data_obj in batch:
+                #A bad frame must not end this task, or gather stops the whole pipeline
+                try:
+                    await self.decode_frame(data_obj)
+                except Exception as e:
+                    logger.exception("Frame object failed to decode:")
+
+    async def decode_frame(self, data_obj):
+        '''Drop a frame that should not be broadcast, or parse its parameters
+        and pass it on to be broadcast.
+        '''
+        try:
+            print("Got a data object")
+            tag = self.reader.param_tag(data_obj)
+            if tag == 'final':
+                logger.info("Received -writedone from LabView")
+                return
+            elif tag == 'garbage':
+                logger.info("!!! Ignoring message with garbage metadata tag from BCS. Probably after a restart.")
+                return
+            elif self.reader.is_null_frame(data_obj):
+                logger.info('Found null frame.  Probably the beginning or end of a scan.')
+                return
+            params = self.reader.parse_params(data_obj['params'])
+            #We must have a valid frame.  Send the frame data, the parameters,
+            #and the frame number on to be broadcast.
+            item = (data_obj['image'], params, data_obj['info'][4])
+        except Exception as e:
+            logger.exception("Frame object failed to parse:")
+            return
+        await self.publish_queue.put(item)
+
+    async def publish_loop(self):
+        '''Broadcast decoded frames over PVA and update the TomoStream PVs.
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.publish_queue.get()
+            try:
+                await loop.run_in_executor(self.executor, self.pva_set.broadcast_image, *item)
+            except Exception as e:
+                logger.exception("Frame failed to broadcast:")
 
 
 def main_loop():
+    tomostream_pva_broadcasters = TomoStreamPVASet()
+    tomostream_pva_broadcasters.start_pva_streams()
+    zmq_stream = ZMQ_Stream(zmq_address, 
+                            zmq_port,
+                            beamline,
+                            tomostream_pva_broadcasters,
+                            )
     try:
-        tomostream_pva_broadcasters = TomoStreamPVASet()
-        tomostream_pva_broadcasters.start_pva_streams()
-        zmq_stream = ZMQ_Stream(zmq_address, 
-                                zmq_port,
-                                beamline,
-                                tomostream_pva_broadcasters,
-                                )
-        zmq_stream.zmq_monitor_loop(0.01)
+        if uvloop is not None:
+            uvloop.run(zmq_stream.zmq_monitor_loop())
+        else:
+            asyncio.run(zmq_stream.zmq_monitor_loop())
     except KeyboardInterrupt as e:
+        logger.error("Ctrl-C Interruption detected, Quitting...")
+    finally:
+        #Shut the PVA servers down however the monitor loop ended
         tomostream_pva_broadcasters.stop_pva_streams()
         zmq_stream.socket.close()
 
@@ -0,0 +1,28 @@
+import pytest
+
+pva_broadcast = pytest.importorskip("pva_broadcast")
+
+
+def test_parse_params_python():
+    '''The pure Python parser, used when bcs_decode is not built.
+    '''
+    reader = pva_broadcast.ReadBCSTomoData()
+    params = reader.parse_params_python(b"-nrays 2560\r\n-nslices 2160\r\n-nangles 1313\r\n"
+                                        b"-arange 180\r\n-image_key 0\r\n-dtype \r\n-other 7\r\n")
+    assert params == pva_broadcast.FrameParams(nrays=2560, nslices=2160, nangles=1313,
+                                               arange=180.0, image_key=0, dtype='uint16')
+
+
+def test_parse_params_python_missing_fields():
+    '''Fields that are not in the params keep their defaults.
+    '''
+    reader = pva_broadcast.ReadBCSTomoData()
+    params = reader.parse_params_python(b"+nrays 640\n+nslices 480\n-image_key 2")
+    assert params == pva_broadcast.FrameParams(nrays=640, nslices=480, image_key=2)
+    assert params.nangles is None and params.arange is None
+
+
+def test_parse_params_python_bad_value():
+    reader = pva_broadcast.ReadBCSTomoData()
+    with pytest.raises(ValueError):
+        reader.parse_params_python(b"-nangles 12x\r\n")
@@ -1,7 +1,4 @@
 import time
-import random
-import threading
-import numpy as np
 import pvaccess as pva
 import util
 
@@ -42,50 +39,6 @@ class FrameGenerator:
         return self.compressorName
 
 
-class NumpyRandomGenerator(FrameGenerator):
-    '''Class to create a set of frames of random numbers.
-    This is mostly useful for test purposes.
-    '''
-    def __init__(self, nf, nx, ny, datatype, minimum, maximum):
-        FrameGenerator.__init__(self)
-        self.nf = nf
-        self.nx = nx
-        self.ny = ny
-        self.datatype = datatype
-        self.minimum = minimum
-        self.maximum = maximum
-        self.generateFrames()
-
-    def generateFrames(self):
-        print('Generating random frames')
-
-        dt = np.dtype(self.datatype)
-        if not self.datatype.startswith('float'):
-            dtinfo = np.iinfo(dt)
-            mn = dtinfo.min
-            if self.minimum is not None:
-                mn = int(max(dtinfo.min, self.minimum))
-            mx = dtinfo.max
-            if self.maximum is not None:
-                mx = int(min(dtinfo.max, self.maximum))
-            self.frames = np.random.randint(mn, mx, size=(self.nf, self.ny, self.nx), dtype=dt)
-        else:
-            # Use float32 for min/max, to prevent overflow errors
-            dtinfo = np.finfo(np.float32)
-            mn = dtinfo.min
-            if self.minimum is not None:
-                mn = float(max(dtinfo.min, self.minimum))
-            mx = dtinfo.max
-            if self.maximum is not None:
-                mx = float(min(dtinfo.max, self.maximum))
-            self.frames = np.random.uniform(mn, mx, size=(self.nf, self.ny, self.nx))
-            if datatype == 'float32':
-                self.frames = np.float32(self.frames)
-
-        print(f'Generated frame shape: {self.frames[0].shape}')
-        print(f'Range of generated values: [{mn},{mx}]')
-
-
 class PVABroadcaster:
     '''Broadcasts images sent to this class over PVA.
     '''
@@ -96,12 +49,43 @@ class PVABroadcaster:
         self.channelName = args.channel_name
         self.pvaServer = pva.PvaServer()
         self.pvaServer.addRecord(self.channelName, pva.NtNdArray(), None)
+        #NtNdArray reused from frame to frame while the image geometry is unchanged
+        self.ntnda = None
+        self.frameShape = None
+        self.frameDtype = None
+        self.dataFieldKey = None
+        #Replaced by fastFrame once the geometry of the stream is known
+        self.frameProducer = self.firstFrame
             
 
-    def frameProducer(self, frameId, frame_data, nx, ny, dtype, compressorName, t=0):
-        startTime = time.time()
-        frame_data, dtype = self.adjust_dtype(frame_data, dtype)
+    def firstFrame(self, frameId, frame_data, nx, ny, dtype, compressorName, t=0):
+        '''Builds a complete NtNdArray for the frame and broadcasts it.
+        For uncompressed frames, keeps the NtNdArray and switches frameProducer to fastFrame.
+        '''
         ntnda = util.AdImageUtility.generateNtNdArray2D(frameId, frame_data, nx, ny, dtype, compressorName, None)
+        if not compressorName:
+            self.ntnda = ntnda
+            self.frameShape = frame_data.shape
+            self.frameDtype = frame_data.dtype
+            self.dataFieldKey = util.AdImageUtility.getNtNdArrayDataFieldKey(frame_data)
+            self.frameProducer = self.fastFrame
+        self.publish(ntnda, t)
+
+    def fastFrame(self, frameId, frame_data, nx, ny, dtype, compressorName, t=0):
+        '''Broadcasts a frame with the same geometry as the last one,
+        only replacing the data, id, and time stamps in the kept NtNdArray.
+        This deliberately does not use AdImageUtility.replaceNtNdArrayImage2D, which
+        rebuilds the value union, rereads the dimensions, and makes its own time stamp.
+        '''
+        if compressorName or frame_data.shape != self.frameShape or frame_data.dtype != self.frameDtype:
+            self.firstFrame(frameId, frame_data, nx, ny, dtype, compressorName, t)
+            return
+        ntnda = self.ntnda
+        ntnda['value'] = {self.dataFieldKey : frame_data.reshape(-1)}
+        ntnda['uniqueId'] = int(frameId)
+        self.publish(ntnda, t)
+
+    def publish(self, ntnda, t=0):
         if t <= 0:
             t = time.time()
         ts = pva.PvTimeStamp(t)
@@ -118,45 +102,3 @@ class PVABroadcaster:
         self.pvaServer.stop()
         time.sleep(self.SHUTDOWN_DELAY)
         print("Shutting down pvaBroadcast")
-
-    def adjust_dtype(self, frame_data, dtype):
-        if frame_data.dtype == 'uint16' or frame_data.dtype == np.uint16:
-            return frame_data, dtype
-        elif frame_data.dtype == '>u2':
-            return frame_data.astype(np.uint16), 'uint16'
-
-class ArgsHolder():
-    pass
-
-
-def test_code(rows = 256, columns = 256, dtype = 'uint8', num_frames = 100, time_delay = 0.1, channel_name = "pvapy1:image"):
-    '''Test that PVA broadcast works as we want it to.
-    '''
-    random_frames = NumpyRandomGenerator(num_frames, columns, rows, dtype, 0, 100)
-    args = ArgsHolder()
-    args.channel_name = "pvapy:image"
-    pvab = PVABroadcaster(args)
-    pvab.start()
-    print(random_frames.frames.shape)
-    for i in range(random_frames.frames.shape[0]):
-        pvab.frameProducer(random_frames.frames[i,...], columns, rows, dtype, None)
-        time.sleep(0.5)
-
-def dual_test():
-    '''Test that PVA broadcast works for two sets of images simultaneously.
-    '''
-    random_frames1 = NumpyRandomGenerator(100, 256, 256, 'uint8', 0, 100)
-    args = ArgsHolder()
-    args.channel_name = "pvapy1:image"
-    pvab = PVABroadcaster(args)
-    pvab.start()
-    random_frames2 = NumpyRandomGenerator(100, 128, 256, 'uint8', 0, 100)
-    args2 = ArgsHolder()
-    args2.channel_name = "pvapy2:image"
-    pvab2 = PVABroadcaster(args2)
-    pvab2.start()
-    print(random_frames1.frames.shape)
-    for i in range(random_frames1.frames.shape[0]):
-        pvab.frameProducer(random_frames1.frames[i,...], 256, 256, 'uint8', None)
-        pvab2.frameProducer(random_frames2.frames[i,...], 128, 256, 'uint8', None)
-        time.sleep(0.5)
@@ -0,0 +1,89 @@
+'''
+Manual checks of PVABroadcaster with frames of random numbers.
+Run from the repository root, e.g.
+    python -c "from tests.pva_random_frames import dual_test; dual_test()"
+'''
+import time
+import numpy as np
+from pva_instance import FrameGenerator, PVABroadcaster
+
+
+class NumpyRandomGenerator(FrameGenerator):
+    '''Class to create a set of frames of random numbers.
+    This is mostly useful for test purposes.
+    '''
+    def __init__(self, nf, nx, ny, datatype, minimum, maximum):
+        FrameGenerator.__init__(self)
+        self.nf = nf
+        self.nx = nx
+        self.ny = ny
+        self.datatype = datatype
+        self.minimum = minimum
+        self.maximum = maximum
+        self.generateFrames()
+
+    def generateFrames(self):
+        print('Generating random frames')
+
+        dt = np.dtype(self.datatype)
+        if not self.datatype.startswith('float'):
+            dtinfo = np.iinfo(dt)
+            mn = dtinfo.min
+            if self.minimum is not None:
+                mn = int(max(dtinfo.min, self.minimum))
+            mx = dtinfo.max
+            if self.maximum is not None:
+                mx = int(min(dtinfo.max, self.maximum))
+            self.frames = np.random.randint(mn, mx, size=(self.nf, self.ny, self.nx), dtype=dt)
+        else:
+            # Use float32 for min/max, to prevent overflow errors
+            dtinfo = np.finfo(np.float32)
+            mn = dtinfo.min
+            if self.minimum is not None:
+                mn = float(max(dtinfo.min, self.minimum))
+            mx = dtinfo.max
+            if self.maximum is not None:
+                mx = float(min(dtinfo.max, self.maximum))
+            self.frames = np.random.uniform(mn, mx, size=(self.nf, self.ny, self.nx))
+            if datatype == 'float32':
+                self.frames = np.float32(self.frames)
+
+        print(f'Generated frame shape: {self.frames[0].shape}')
+        print(f'Range of generated values: [{mn},{mx}]')
+
+
+class ArgsHolder():
+    pass
+
+
+def test_code(rows = 256, columns = 256, dtype = 'uint8', num_frames = 100, time_delay = 0.1, channel_name = "pvapy1:image"):
+    '''Test that PVA broadcast works as we want it to.
+    '''
+    random_frames = NumpyRandomGenerator(num_frames, columns, rows, dtype, 0, 100)
+    args = ArgsHolder()
+    args.channel_name = "pvapy:image"
+    pvab = PVABroadcaster(args)
+    pvab.start()
+    print(random_frames.frames.shape)
+    for i in range(random_frames.frames.shape[0]):
+        pvab.frameProducer(i, random_frames.frames[i,...], columns, rows, dtype, None)
+        time.sleep(0.5)
+
+def dual_test():
+    '''Test that PVA broadcast works for two sets of images simultaneously.
+    '''
+    random_frames1 = NumpyRandomGenerator(100, 256, 256, 'uint8', 0, 100)
+    args = ArgsHolder()
+    args.channel_name = "pvapy1:image"
+    pvab = PVABroadcaster(args)
+    pvab.start()
+    random_frames2 = NumpyRandomGenerator(100, 128, 256, 'uint8', 0, 100)
+    args2 = ArgsHolder()
+    args2.channel_name = "pvapy2:image"
+    pvab2 = PVABroadcaster(args2)
+    pvab2.start()
+    print(random_frames1.frames.shape)
+    for i in range(random_frames1.frames.shape[0]):
+        pvab.frameProducer(i, random_frames1.frames[i,...], 256, 256, 'uint8', None)
+        pvab2.frameProducer(i, random_frames2.frames[i,...], 128, 256, 'uint8', None)
+        time.sleep(0.5)